@@ -2,29 +2,104 @@
 
 import argparse
 import ast
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
-import glob
+from functools import lru_cache
+from multiprocessing.util import Finalize
+import hashlib
 import logging
+import operator
 import os
-from typing import List, Optional, Union
+import pickle
+import re
+import sqlite3
+import sys
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple, Union
 from enum import Enum
 
 
+CACHE_FILE = ".source_layout_cache.sqlite"
+
+
 class StrEnum(str, Enum):
     def __str__(self) -> str:
         return self.value
 
 
 class Issue:
-    def __init__(self, line: int, msg: str):
+    __slots__ = ("line", "name", "prev_name")
+
+    # only the names are kept, the message is formatted when it is reported
+    def __init__(self, line: int, name: str, prev_name: str):
         self.line = line
-        self.msg = msg
+        self.name = name
+        self.prev_name = prev_name
+
+    @property
+    def msg(self) -> str:
+        return f'"{self.name}" should not be after "{self.prev_name}"'
 
     def __repr__(self):
         return f"Issue(line={self.line}, msg={self.msg})"
 
 
-class DeclType(Enum):
+def _issue_fields(issue: Issue) -> Tuple[int, str, str]:
+    return issue.line, issue.name, issue.prev_name
+
+
+# cached issues are only valid for the analysis that produced them, so the
+# cache is versioned by a hash of this file: any change to the classification,
+# the ordering rules or the pickled layout starts it afresh
+@lru_cache(maxsize=None)
+def _cache_version() -> int:
+    with open(__file__, "rb") as f:
+        digest = hashlib.sha256(f.read()).digest()
+    # PRAGMA user_version holds a signed 32-bit integer
+    return int.from_bytes(digest[:4], "big", signed=True)
+
+
+class IssueCache:
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        (version,) = self.conn.execute("PRAGMA user_version").fetchone()
+        if version != _cache_version():
+            with self.conn:
+                self.conn.execute("DROP TABLE IF EXISTS cache")
+                self.conn.execute(f"PRAGMA user_version = {_cache_version()}")
+        # one row per path, so a newer hash replaces the old entry
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache"
+            " (path TEXT PRIMARY KEY, hash BLOB, issues BLOB)"
+        )
+
+    def get(self, path: str, digest: bytes) -> Optional[List[Issue]]:
+        row = self.conn.execute(
+            "SELECT issues FROM cache WHERE path = ? AND hash = ?", (path, digest)
+        ).fetchone()
+        if row is None:
+            return None
+        return [Issue(*fields) for fields in pickle.loads(row[0])]
+
+    def put_many(self, entries: Iterable[Tuple[str, bytes, List[Issue]]]):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                (
+                    (path, digest, pickle.dumps([_issue_fields(i) for i in issues]))
+                    for path, digest, issues in entries
+                ),
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+# plain ints rather than an Enum: the only thing we do with them is compare
+# their order, and that is on the hot path of check_order
+class DeclType:
     ROOT = 0
     IMPORT = 1
     CLASS_DECL = 2
@@ -36,146 +111,243 @@ class DeclType(Enum):
     PRIVATE_METHOD = 8
 
 
+_DECL_TYPE_NAMES = (
+    "root",
+    "import",
+    "class_decl",
+    "class_var",
+    "magic_method",
+    "static_method",
+    "getter_setter",
+    "public_method",
+    "private_method",
+)
+
+
+_STATIC_DECORATORS = frozenset({"staticmethod"})
+_PROPERTY_DECORATORS = frozenset({"property"})
+_PROPERTY_ATTR_DECORATORS = frozenset({"setter"})
+
+
+# method names repeat a lot across classes (__init__, __repr__, ...), so
+# remember what each one classifies as
+@lru_cache(maxsize=None)
+def _classify_name(name: str) -> int:
+    if name[:2] == "__" and name[-2:] == "__":
+        return DeclType.MAGIC_METHOD
+    if name[:1] == "_":
+        return DeclType.PRIVATE_METHOD
+    return DeclType.PUBLIC_METHOD
+
+
 class DeclNode:
-    def __init__(self, decl_type: DeclType, name: str, line: int):
-        self.decl_type: DeclType = decl_type
+    __slots__ = ("decl_type", "name", "children", "line")
+
+    def __init__(self, decl_type: int, name: str, line: int):
+        self.decl_type: int = decl_type
         self.name: str = name
         self.children: List[DeclNode] = []
         self.line: int = line
 
     def __repr__(self):
-        return f"DeclTree({self.decl_type}, {self.name})"
+        return f"DeclTree({_DECL_TYPE_NAMES[self.decl_type]}, {self.name})"
 
     def add_child(self, child: "DeclNode"):
         self.children.append(child)
 
     def check_order(self) -> List[Issue]:
-        prev: Optional[DeclNode] = None
         issues: List[Issue] = []
-        for child in self.children:
-            if prev is None:
-                prev = child
-                continue
-            if child.decl_type.value < prev.decl_type.value:
-                issues.append(
-                    Issue(
-                        child.line, f'"{child.name}" should not be after "{prev.name}"'
-                    )
-                )
-            prev = child
-        for child in self.children:
-            child_issues = child.check_order()
-            issues.extend(child_issues)
+        stack: List[DeclNode] = [self]
+        # bound once, this loop runs for every declaration in the file
+        append = issues.append
+        pop = stack.pop
+        extend = stack.extend
+        issue_ = Issue
+        while stack:
+            children = pop().children
+            prev_name = ""
+            prev_value = -1
+            for child in children:
+                value = child.decl_type
+                name = child.name
+                if value < prev_value:
+                    append(issue_(child.line, name, prev_name))
+                prev_name = name
+                prev_value = value
+            # reversed so that subtrees are reported in source order
+            extend(reversed(children))
 
         return issues
 
     def pretty_print(self, indent: int = 0) -> str:
-        lines = []
-        lines.append(
-            f"{' ' * indent}{self.line} {self.decl_type.value} {self.decl_type.name.lower()} {self.name}"
-        )
-        for child in self.children:
-            lines.append(child.pretty_print(indent + 4))
+        lines: List[str] = []
+        stack: List[Tuple[DeclNode, int]] = [(self, indent)]
+        while stack:
+            node, node_indent = stack.pop()
+            lines.append(
+                f"{' ' * node_indent}{node.line} {node.decl_type} {_DECL_TYPE_NAMES[node.decl_type]} {node.name}"
+            )
+            stack.extend(
+                (child, node_indent + 4) for child in reversed(node.children)
+            )
         return "\n".join(lines)
 
 
-class Analyzer:
-    def __init__(self, path: str):
-        self.path = path
-
-    @staticmethod
-    def process(path: str) -> List[Issue]:
-        return Analyzer(path)._analyze_file(path)  # pylint: disable=protected-access
-
-    def _analyze_module(self, module: ast.Module) -> DeclNode:
-        decl_tree = DeclNode(DeclType.ROOT, "root", 0)
-        for i, node in enumerate(module.body):
-            if isinstance(node, ast.ClassDef):
-                decl_tree.add_child(self._analyze_class(node))
-            elif isinstance(node, ast.FunctionDef):
-                decl_tree.add_child(self._analyze_function(node))
-            elif isinstance(node, ast.Import):
-                decl_tree.add_child(self._analyze_import(node))
-            else:
-                # logging.debug("skip module line %s:%s %s", self.path, node.lineno, node)
-                pass
-        return decl_tree
-
-    def _analyze_import(self, node: ast.Import) -> DeclNode:
-        names: List[str] = []
-        for alias in node.names:
-            names.append(alias.name)
-        return DeclNode(DeclType.IMPORT, ",".join(names), node.lineno)
-
-    def _analyze_class(self, node: ast.ClassDef) -> DeclNode:
-        decl_tree = DeclNode(DeclType.CLASS_DECL, node.name, node.lineno)
-        for i, child in enumerate(node.body):
-            if isinstance(child, ast.Assign):
-                decl_tree.add_child(self._analyze_class_var(child))
-            elif isinstance(child, ast.FunctionDef):
-                decl_tree.add_child(self._analyze_function(child))
-            elif isinstance(child, ast.AnnAssign):
-                decl_tree.add_child(self._analyze_class_var(child))
-            else:
-                # logging.debug(
-                #     "skip class line %s:%s %s", self.path, child.lineno, child
-                # )
+# every statement we build a DeclNode from starts with one of these keywords,
+# either at the start of a line (compile() also accepts bare "\r" line endings
+# and a leading UTF-8 BOM) or after a ";". "from" imports are not analyzed, so
+# they do not count
+_DECL_PATTERN = re.compile(
+    rb"(?:^|(?<=[\r;]))(?:\xef\xbb\xbf)?[ \t\f]*(?:class|def|import)\b", re.M
+)
+
+# per-process cache, set up by open_cache in each worker
+_cache: Optional[IssueCache] = None
+
+
+def open_cache(cache_path: Optional[str]):
+    global _cache  # pylint: disable=global-statement
+    if cache_path is None:
+        return
+    try:
+        _cache = IssueCache(cache_path)
+    except sqlite3.Error:
+        # the main process has already checked the cache and warned if it
+        # was unusable, so just run uncached
+        _cache = None
+        return
+    # pool workers exit without running ordinary finalizers, and a connection
+    # that is never closed leaves the -wal/-shm files behind
+    Finalize(_cache, _cache.close, exitpriority=0)
+
+
+# (issues, digest, parse error, declaration tree dump)
+Result = Tuple[List[Issue], Optional[bytes], Optional[str], Optional[str]]
+
+
+# this runs in the worker processes, which may not have logging set up, so
+# anything worth reporting is handed back to the main process to log in order.
+# the digest is only returned for freshly computed issues that should be
+# written back to the cache, and the tree dump only when verbose is set
+def process(path: str, verbose: bool = False) -> Result:
+    # compile() decodes the source itself, honouring any PEP 263 coding
+    # declaration, so there is no need to go through a text file
+    with open(path, "rb") as f:
+        data = f.read()
+
+    # with fewer than two declarations nothing can be out of order, which is
+    # common enough (__init__.py shims, stubs) to be worth skipping the parse
+    matches = _DECL_PATTERN.finditer(data)
+    if next(matches, None) is None or next(matches, None) is None:
+        return [], None, None, None
+
+    digest = None
+    if _cache is not None:
+        digest = hashlib.sha256(data).digest()
+        issues = None
+        # a hit has no tree to dump, so verbose runs always reparse
+        if not verbose:
+            try:
+                issues = _cache.get(path, digest)
+            except sqlite3.Error:
                 pass
-
-        return decl_tree
-
-    def _analyze_class_var(self, node: Union[ast.AnnAssign, ast.Assign]) -> DeclNode:
-        if isinstance(node, ast.AnnAssign):
-            if isinstance(node.target, ast.Name):
-                name = node.target.id
-            elif isinstance(node.target, ast.Attribute):
-                name = node.target.attr
-            else:
-                name = "unknown"
-            return DeclNode(DeclType.CLASS_VAR, name, node.lineno)
-        if isinstance(node, ast.Assign):
-            if len(node.targets) == 0:
-                name = "unknown"
-            elif isinstance(node.targets[0], ast.Name):
-                name = node.targets[0].id
-            elif isinstance(node.targets[0], ast.Attribute):
-                name = node.targets[0].attr
-            else:
-                name = "unknown"
-            return DeclNode(DeclType.CLASS_VAR, name, node.lineno)
-
-    def _analyze_function(self, node: ast.FunctionDef) -> DeclNode:
-        if len(node.decorator_list) > 0:
-            if isinstance(node.decorator_list[0], ast.Name):
-                if node.decorator_list[0].id == "staticmethod":
-                    return DeclNode(DeclType.STATIC_METHOD, node.name, node.lineno)
-                # property
-                if node.decorator_list[0].id == "property":
-                    return DeclNode(DeclType.GETTER_SETTER, node.name, node.lineno)
-            # also treat @xx.setter as property
-            if isinstance(node.decorator_list[0], ast.Attribute):
-                if node.decorator_list[0].attr == "setter":
-                    return DeclNode(DeclType.GETTER_SETTER, node.name, node.lineno)
-        if node.name.startswith("__") and node.name.endswith("__"):
-            return DeclNode(DeclType.MAGIC_METHOD, node.name, node.lineno)
-        if node.name.startswith("_"):
-            return DeclNode(DeclType.PRIVATE_METHOD, node.name, node.lineno)
-
-        return DeclNode(DeclType.PUBLIC_METHOD, node.name, node.lineno)
-
-    def _analyze_file(self, path: str) -> List[Issue]:
-        with open(path, "r", encoding="utf-8") as f:
-            text = f.read()
-
-        try:
-            module = ast.parse(text)
-        except Exception as ex:
-            logging.error("failed to parse %s: %s", path, ex)
-            return []
-        decl_tree = self._analyze_module(module)
-        logging.debug("Declaration tree (LINE | NAME):")
-        logging.debug(decl_tree.pretty_print())
-        return decl_tree.check_order()
+        if issues is not None:
+            return issues, None, None, None
+
+    try:
+        module = compile(data, path, "exec", flags=ast.PyCF_ONLY_AST, dont_inherit=True)
+    except Exception as ex:
+        return [], None, str(ex), None
+    decl_tree = _analyze_module(module)
+    # pretty_print walks the whole tree, so only build it when it is shown
+    tree = decl_tree.pretty_print() if verbose else None
+    return decl_tree.check_order(), digest, None, tree
+
+
+def _analyze_module(module: ast.Module) -> DeclNode:
+    decl_tree = DeclNode(DeclType.ROOT, "root", 0)
+    dispatch = _MODULE_DISPATCH
+    for node in module.body:
+        handler = dispatch.get(type(node))
+        if handler is not None:
+            decl_tree.add_child(handler(node))
+        else:
+            # if logging.getLogger().isEnabledFor(logging.DEBUG):
+            #     logging.debug("skip module line %s %s", node.lineno, node)
+            pass
+    return decl_tree
+
+
+def _analyze_import(node: ast.Import) -> DeclNode:
+    names: List[str] = []
+    for alias in node.names:
+        names.append(alias.name)
+    return DeclNode(DeclType.IMPORT, ",".join(names), node.lineno)
+
+
+def _analyze_class(node: ast.ClassDef) -> DeclNode:
+    decl_tree = DeclNode(DeclType.CLASS_DECL, node.name, node.lineno)
+    dispatch = _CLASS_DISPATCH
+    for child in node.body:
+        handler = dispatch.get(type(child))
+        if handler is not None:
+            decl_tree.add_child(handler(child))
+        else:
+            # if logging.getLogger().isEnabledFor(logging.DEBUG):
+            #     logging.debug("skip class line %s %s", child.lineno, child)
+            pass
+
+    return decl_tree
+
+
+def _analyze_class_var(node: Union[ast.AnnAssign, ast.Assign]) -> DeclNode:
+    if type(node) is ast.AnnAssign:
+        target: Optional[ast.expr] = node.target
+    elif node.targets:
+        target = node.targets[0]
+    else:
+        target = None
+    get_name = _TARGET_NAME.get(type(target))
+    name = get_name(target) if get_name is not None else "unknown"
+    return DeclNode(DeclType.CLASS_VAR, name, node.lineno)
+
+
+def _analyze_function(node: ast.FunctionDef) -> DeclNode:
+    name = node.name
+    lineno = node.lineno
+    if node.decorator_list:
+        decorator = node.decorator_list[0]
+        if isinstance(decorator, ast.Name):
+            if decorator.id in _STATIC_DECORATORS:
+                return DeclNode(DeclType.STATIC_METHOD, name, lineno)
+            # property
+            if decorator.id in _PROPERTY_DECORATORS:
+                return DeclNode(DeclType.GETTER_SETTER, name, lineno)
+        # also treat @xx.setter as property
+        elif isinstance(decorator, ast.Attribute):
+            if decorator.attr in _PROPERTY_ATTR_DECORATORS:
+                return DeclNode(DeclType.GETTER_SETTER, name, lineno)
+
+    return DeclNode(_classify_name(name), name, lineno)
+
+
+# node type -> handler for top-level statements
+_MODULE_DISPATCH = {
+    ast.ClassDef: _analyze_class,
+    ast.FunctionDef: _analyze_function,
+    ast.Import: _analyze_import,
+}
+# node type -> handler for statements in a class body
+_CLASS_DISPATCH = {
+    ast.Assign: _analyze_class_var,
+    ast.AnnAssign: _analyze_class_var,
+    ast.FunctionDef: _analyze_function,
+}
+# target type -> name of the assigned class variable
+_TARGET_NAME = {
+    ast.Name: operator.attrgetter("id"),
+    ast.Attribute: operator.attrgetter("attr"),
+}
 
 
 if __name__ == "__main__":
@@ -184,6 +356,7 @@ if __name__ == "__main__":
     class _Args:
         path: str
         verbose: bool
+        no_cache: bool
 
     class Colors(StrEnum):
         GREY = "\x1b[38;20m"
@@ -206,18 +379,43 @@ if __name__ == "__main__":
             logging.CRITICAL: Colors.BOLD_RED + format_ + Colors.RESET,
         }
 
+        def __init__(self):
+            super().__init__()
+            self._formatters = {
+                level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()
+            }
+
         def format(self, record):
-            log_fmt = self.FORMATS.get(record.levelno)
-            formatter = logging.Formatter(log_fmt)
+            formatter = self._formatters.get(record.levelno)
+            if formatter is None:
+                return super().format(record)
             return formatter.format(record)
 
     def handle_issues(file: str, issues: List[Issue]):
         if len(issues) == 0:
             return
-        logging.error("Found issues in %s:", file)
-        for issue in issues:
-            # print(f"    {file}:{issue.line} {issue.msg}")
-            logging.info("    %s:%s %s", file, issue.line, issue.msg)
+        # one record per file rather than one per issue
+        lines = "\n".join(f"    {file}:{issue.line} {issue.msg}" for issue in issues)
+        logging.error("Found issues in %s:\n%s", file, lines)
+
+    def iter_py_files(root: str) -> Iterator[str]:
+        # skips hidden entries like glob's "**" did, but unlike glob it
+        # deliberately does not follow symlinked directories, to avoid cycles
+        # and reporting the same files twice
+        try:
+            with os.scandir(root) as it:
+                entries = list(it)
+        except OSError as ex:
+            # like glob, don't let one unreadable directory abort the run
+            logging.warning("skipping %s: %s", root, ex.strerror)
+            return
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_py_files(entry.path)
+            elif entry.name.endswith(".py") and entry.is_file():
+                yield entry.path
 
     def parse_args() -> _Args:
         parser = argparse.ArgumentParser(
@@ -227,29 +425,82 @@ if __name__ == "__main__":
         parser.add_argument(
             "-v", "--verbose", action="store_true", help="verbose output"
         )
+        parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            help=f"do not read or write the {CACHE_FILE} cache",
+        )
         args = parser.parse_args()
         return _Args(**vars(args))
 
-    def init_logger():
+    def init_logger(verbose: bool):
         ch = logging.StreamHandler()
         ch.setLevel(logging.DEBUG)
         ch.setFormatter(CustomFormatter())
         default_logger = logging.getLogger()
-        default_logger.setLevel(
-            logging.INFO if not parse_args().verbose else logging.DEBUG
-        )
+        default_logger.setLevel(logging.DEBUG if verbose else logging.INFO)
         default_logger.addHandler(ch)
 
     def main():
-        init_logger()
         args = parse_args()
+        init_logger(args.verbose)
+        if not os.path.exists(args.path):
+            logging.error("%s: no such file or directory", args.path)
+            sys.exit(1)
+        cache_path = None if args.no_cache else CACHE_FILE
+        if cache_path is not None:
+            # create the schema before the workers open the file, but do not
+            # keep a connection open across the fork
+            try:
+                IssueCache(cache_path).close()
+            except sqlite3.Error as ex:
+                logging.warning("not using cache %s: %s", cache_path, ex)
+                cache_path = None
+        fresh: List[Tuple[str, bytes, List[Issue]]] = []
+
+        def report(path: str, result: Result):
+            issues, digest, error, tree = result
+            if error is not None:
+                logging.error("failed to parse %s: %s", path, error)
+            if tree is not None:
+                logging.debug("Declaration tree (LINE | NAME):\n%s", tree)
+            handle_issues(path, issues)
+            if digest is not None:
+                fresh.append((path, digest, issues))
+
         if os.path.isfile(args.path):
-            files = [args.path]
+            # not worth starting a pool for
+            open_cache(cache_path)
+            report(args.path, process(args.path, args.verbose))
         else:
-            args.path = args.path.rstrip("/")
-            files = glob.glob(f"{args.path}/**/*.py", recursive=True)
-        for path in files:
-            issues = Analyzer.process(path)
-            handle_issues(path, issues)
+            # files are independent, so fan them out over all cores and report
+            # the results back in order from the main process
+            workers = os.cpu_count() or 1
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=open_cache,
+                initargs=(cache_path,),
+            ) as executor:
+                # submit files while the tree is still being walked, but keep
+                # only a bounded window in flight so a large tree is never
+                # queued whole
+                pending: Deque[Tuple[str, Future]] = deque()
+                for path in iter_py_files(args.path):
+                    future = executor.submit(process, path, args.verbose)
+                    pending.append((path, future))
+                    if len(pending) >= workers * 2:
+                        path, future = pending.popleft()
+                        report(path, future.result())
+                while pending:
+                    path, future = pending.popleft()
+                    report(path, future.result())
+        if cache_path is not None and fresh:
+            # one transaction for the whole run
+            try:
+                cache = IssueCache(cache_path)
+                cache.put_many(fresh)
+                cache.close()
+            except sqlite3.Error as ex:
+                logging.warning("failed to update cache %s: %s", cache_path, ex)
 
     main()
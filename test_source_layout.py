@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+import source_layout
+
+
+class SkipParseTest(unittest.TestCase):
+    # each source has exactly one violation, which the skip-parse shortcut
+    # must not hide
+    CASES = {
+        "lf": b"import os\ndef f(): pass\nimport sys\n",
+        "crlf": b"import os\r\ndef f(): pass\r\nimport sys\r\n",
+        "cr": b"import os\rdef f(): pass\rimport sys\r",
+        "bom": b"\xef\xbb\xbfdef f(): pass\nimport os\n",
+        "semicolon": b"def f(): pass\nx = 1; import os\n",
+    }
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def analyze(self, data: bytes):
+        path = os.path.join(self.tmp.name, "case.py")
+        with open(path, "wb") as f:
+            f.write(data)
+        return source_layout.process(path)
+
+    def test_violations_are_not_skipped(self):
+        for name, data in self.CASES.items():
+            with self.subTest(name):
+                issues, _, error, _ = self.analyze(data)
+                self.assertIsNone(error)
+                self.assertEqual(len(issues), 1)
+
+    def test_from_imports_are_skipped(self):
+        issues, _, error, _ = self.analyze(
+            b"from .a import x\nfrom .b import y\nfrom .c import (\n"
+        )
+        self.assertEqual(issues, [])
+        self.assertIsNone(error)
+
+    def test_single_declaration_is_skipped(self):
+        # a syntax error would be reported if the file were parsed
+        issues, _, error, _ = self.analyze(b"def f(:\n")
+        self.assertEqual(issues, [])
+        self.assertIsNone(error)
+
+
+if __name__ == "__main__":
+    unittest.main()